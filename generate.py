@@ -14,7 +14,9 @@ Ref:
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import gc
+import io
 import json
 import math
 import os
@@ -24,24 +26,56 @@ import numpy as np
 from PIL import Image
 import torch
 import torch.distributed as dist
+from torch.nn.attention import SDPBackend, sdpa_kernel
 from tqdm import tqdm
 
 from models.sit import SiT_models
 from models.autoencoder import vae_models
 from samplers import euler_sampler, euler_maruyama_sampler
-from utils import load_encoders, denormalize_latents
+from utils import load_encoders
+
+
+SAMPLES_PER_SUBDIR = 1000
+
+
+def sample_path(sample_dir, index):
+    """
+    Path of the .png sample with the given index. Samples are split across subdirectories of
+    SAMPLES_PER_SUBDIR files each, to avoid a single directory with tens of thousands of entries.
+    NOTE: earlier versions used a flat `{sample_dir}/{index:06d}.png` layout.
+    """
+    return f"{sample_dir}/{index // SAMPLES_PER_SUBDIR:03d}/{index:06d}.png"
 
 
 def create_npz_from_sample_folder(sample_dir, num=50_000):
     """
     Builds a single .npz file from a folder of .png samples.
     """
-    samples = []
-    for i in tqdm(range(num), desc="Building .npz file from samples"):
-        sample_pil = Image.open(f"{sample_dir}/{i:06d}.png")
-        sample_np = np.asarray(sample_pil).astype(np.uint8)
-        samples.append(sample_np)
-    samples = np.stack(samples)
+    def load_sample(i):
+        samples[i] = np.asarray(Image.open(sample_path(sample_dir, i)))
+
+    # Decode the first sample to get the resolution, then decode the rest in parallel into a preallocated buffer
+    sample_np = np.asarray(Image.open(sample_path(sample_dir, 0)))
+    samples = np.empty((num, *sample_np.shape), dtype=np.uint8)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(tqdm(executor.map(load_sample, range(num)), total=num, desc="Building .npz file from samples"))
+    assert samples.shape == (num, samples.shape[1], samples.shape[2], 3)
+    npz_path = f"{sample_dir}.npz"
+    np.savez(npz_path, arr_0=samples)
+    print(f"Saved .npz file to {npz_path} [shape={samples.shape}].")
+    return npz_path
+
+
+def create_npz_from_sample_shards(sample_dir, world_size, num=50_000):
+    """
+    Builds a single .npz file from the per-rank .npy sample shards.
+    """
+    shards = [np.load(f"{sample_dir}/rank{rank}.npy", mmap_mode="r") for rank in range(world_size)]
+    samples = np.empty((num, *shards[0].shape[1:]), dtype=np.uint8)
+    for rank, shard in enumerate(tqdm(shards, desc="Building .npz file from samples")):
+        # The j-th sample of a rank has the global index j * world_size + rank
+        rank_samples = samples[rank::world_size]
+        rank_samples[:] = shard[:len(rank_samples)]
     assert samples.shape == (num, samples.shape[1], samples.shape[2], 3)
     npz_path = f"{sample_dir}.npz"
     np.savez(npz_path, arr_0=samples)
@@ -49,13 +83,49 @@ def create_npz_from_sample_folder(sample_dir, num=50_000):
     return npz_path
 
 
+def to_uint8_images(samples):
+    """
+    Converts (N, 3, H, W) decoded samples in [-1, 1] to contiguous (N, H, W, 3) uint8 images.
+    """
+    samples = torch.clamp(255. * ((samples.to(torch.float32) + 1) / 2.), 0, 255)
+    return samples.permute(0, 2, 3, 1).to(torch.uint8).contiguous()
+
+
+def save_samples(samples, indices, sample_dir, compress_level=1):
+    """
+    Saves a batch of (N, H, W, 3) uint8 samples to disk as individual .png files.
+    PNG is lossless, a low compression level only trades disk space for much faster encoding.
+    """
+    for sample, index in zip(samples, indices):
+        # Encode in memory and write the bytes without PIL's buffered file I/O. Write to a temporary file first,
+        # so that an interrupted run never leaves a truncated .png behind (at the cost of one rename per sample)
+        buffer = io.BytesIO()
+        Image.fromarray(sample).save(buffer, format="PNG", compress_level=compress_level)
+        path = sample_path(sample_dir, index)
+        fd = os.open(f"{path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # `os.write` may write fewer bytes than requested, e.g. on networked filesystems
+            view = memoryview(buffer.getbuffer())
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        os.replace(f"{path}.tmp", path)
+
+
+def save_samples_to_shard(samples, offset, shard):
+    """
+    Writes a batch of (N, H, W, 3) uint8 samples to the rows [offset, offset + N) of a memory-mapped .npy shard.
+    """
+    shard[offset:offset + len(samples)] = samples
+
+
 def main(args):
     """
     Run sampling.
     """
     torch.backends.cuda.matmul.allow_tf32 = args.tf32  # True: fast but may lead to some small numerical differences
     assert torch.cuda.is_available(), "Sampling with DDP requires at least one GPU. sample.py supports CPU-only usage"
-    torch.set_grad_enabled(False)
 
     # Setup DDP
     dist.init_process_group("nccl")
@@ -91,7 +161,8 @@ def main(args):
     del encoders
     gc.collect()
 
-    block_kwargs = {"fused_attn": config.fused_attn, "qk_norm": config.qk_norm}
+    # Always sample with `F.scaled_dot_product_attention`, regardless of the training config (numerically equivalent)
+    block_kwargs = {"fused_attn": True, "qk_norm": config.qk_norm}
     model = SiT_models[config.model](
         input_size=latent_size,
         in_channels=in_channels,
@@ -111,6 +182,10 @@ def main(args):
     )
     model.load_state_dict(state_dict['ema'])
     model.eval()  # Important! To disable label dropout during sampling
+    if rank == 0:
+        # Count the parameters before quantization / compilation, which wrap the weights
+        print(f"SiT Parameters: {sum(p.numel() for p in model.parameters()):,}")
+        print(f"projector Parameters: {sum(p.numel() for p in model.projectors.parameters()):,}")
 
     # Load the VAE and latent stats
     vae = vae_models[config.vae]().to(device)
@@ -134,12 +209,49 @@ def main(args):
 
     vae.load_state_dict(vae_state_dict)
     vae.eval()
-
+    vae.fuse_qkv_projections()
+    vae.enable_sdpa()
+
+    # With mixed precision, cast the weights once instead of letting autocast re-cast them on every call
+    # (which a compiled graph would repeat at every step). Activations are still handled by autocast.
+    autocast_dtype = {"no": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}[args.mixed_precision]
+    if args.mixed_precision != "no":
+        model.to(autocast_dtype)
+        vae.to(autocast_dtype)
+
+    # Keep the latent stats on device in the VAE dtype, and precompute the reciprocal of the scale once
+    vae_dtype = next(vae.parameters()).dtype
+    latents_scale = latents_scale.to(device=device, dtype=vae_dtype).contiguous()
+    latents_bias = latents_bias.to(device=device, dtype=vae_dtype).contiguous()
+    latents_inv_scale = latents_scale.reciprocal()
+
+    # NOTE: no `torch.cuda.empty_cache()` here, the cached blocks of the checkpoint are reused for sampling
     del state_dict, vae_state_dict
     gc.collect()
-    torch.cuda.empty_cache()
+
+    if args.int8_quant:
+        assert args.mixed_precision == "bf16", "int8 quantization requires --mixed-precision bf16"
+        # torchao's quantized weights are tensor subclasses, which torch.compile does not handle on torch < 2.5
+        assert not args.compile, "int8 quantization is not supported together with --compile"
+        # torchao is an optional dependency, only required for int8 quantization
+        from torchao.quantization import quantize_, int8_dynamic_activation_int8_weight
+        # NOTE: only nn.Linear layers are quantized, the (conv-only) VAE decoder is left as is
+        quantize_(model, int8_dynamic_activation_int8_weight())
+
+    if args.compile:
+        # The samplers only call `model.inference`, with a fixed batch size for the whole run (x2 inside the
+        # guidance interval), so CUDA graphs are captured once per shape and replayed for every step
+        model.inference = torch.compile(model.inference, mode="reduce-overhead", fullgraph=False, dynamic=False)
+        vae.decoder = torch.compile(vae.decoder, mode="reduce-overhead", fullgraph=False, dynamic=False)
+        # Fuses the post-processing into a single kernel. No CUDA graphs here, as the output is read
+        # asynchronously by the copy stream and must not be overwritten by the next replay
+        postprocess = torch.compile(to_uint8_images, fullgraph=True, dynamic=False)
+    else:
+        postprocess = to_uint8_images
 
     assert args.cfg_scale >= 1.0, "cfg_scale should be >= 1.0"
+    assert args.num_workers >= 1, "num_workers should be >= 1"
+    assert not args.resume or args.sample_format == "png", "--resume is only supported with --sample-format png"
 
     sample_folder_dir = f"{args.sample_dir}/{exp_name}_{train_step_str}_cfg{args.cfg_scale}-{args.guidance_low}-{args.guidance_high}"
     skip = torch.tensor([False], device=device)
@@ -149,14 +261,13 @@ def main(args):
             print(f"Skipping sampling as {sample_folder_dir}.npz already exists.")
         else:
             os.makedirs(sample_folder_dir, exist_ok=True)
-            print(f"Saving .png samples at {sample_folder_dir}")
+            print(f"Saving .{args.sample_format} samples at {sample_folder_dir}")
 
     # Broadcast the skip flag to all processes
     dist.broadcast(skip, src=0)
     if skip.item():
         dist.destroy_process_group()
         return
-    dist.barrier()
 
     # Figure out how many samples we need to generate on each GPU and how many iterations we need to run:
     n = args.pproc_batch_size
@@ -165,58 +276,167 @@ def main(args):
     total_samples = int(math.ceil(args.num_fid_samples / global_batch_size) * global_batch_size)
     if rank == 0:
         print(f"Total number of images that will be sampled: {total_samples}")
-        print(f"SiT Parameters: {sum(p.numel() for p in model.parameters()):,}")
-        print(f"projector Parameters: {sum(p.numel() for p in model.projectors.parameters()):,}")
     assert total_samples % dist.get_world_size() == 0, "total_samples must be divisible by world_size"
     samples_needed_this_gpu = int(total_samples // dist.get_world_size())
     assert samples_needed_this_gpu % n == 0, "samples_needed_this_gpu must be divisible by the per-GPU batch size"
     iterations = int(samples_needed_this_gpu // n)
-    pbar = range(iterations)
-    pbar = tqdm(pbar) if rank == 0 else pbar
-    total = 0
-    for _ in pbar:
-        # Sample inputs:
-        z = torch.randn(n, model.in_channels, latent_size, latent_size, device=device)
-        y = torch.randint(0, config.num_classes, (n,), device=device)
-
-        assert not args.heun or args.mode == "ode", "Heun's method is only available for ODE sampling."
-
-        # Sample images:
-        sampling_kwargs = dict(
-            model=model, 
-            latents=z,
-            y=y,
-            num_steps=args.num_steps, 
-            heun=args.heun,
-            cfg_scale=args.cfg_scale,
-            guidance_low=args.guidance_low,
-            guidance_high=args.guidance_high,
-            path_type=args.path_type,
+
+    if args.sample_format == "png":
+        # Create the subdirectories up front, so that the save threads never have to
+        subdirs = [f"{sample_folder_dir}/{i:03d}" for i in range(math.ceil(total_samples / SAMPLES_PER_SUBDIR))]
+        for subdir in subdirs:
+            os.makedirs(subdir, exist_ok=True)
+
+    # Resume: skip the iterations whose samples were already saved on all ranks by a previous run.
+    # NOTE: the sample folder name does not encode all sampling args, resuming with different args mixes samples
+    done = torch.zeros(iterations, dtype=torch.int32)
+    if args.resume:
+        existing = set(
+            int(f[:6]) for subdir in subdirs for f in os.listdir(subdir) if f.endswith(".png") and f[:6].isdigit()
         )
-        with torch.no_grad():
-            if args.mode == "sde":
-                samples = euler_maruyama_sampler(**sampling_kwargs).to(torch.float32)
-            elif args.mode == "ode":
-                samples = euler_sampler(**sampling_kwargs).to(torch.float32)
-            else:
-                raise NotImplementedError()
-
-            samples = vae.decode(denormalize_latents(samples, latents_scale, latents_bias)).sample
-            samples = (samples + 1) / 2.
-            samples = torch.clamp(
-                255. * samples, 0, 255
-            ).permute(0, 2, 3, 1).to("cpu", dtype=torch.uint8).numpy()
-
-            # Save samples to disk as individual .png files
-            for i, sample in enumerate(samples):
-                index = i * dist.get_world_size() + rank + total
-                Image.fromarray(sample).save(f"{sample_folder_dir}/{index:06d}.png")
-        total += global_batch_size
+        for it in range(iterations):
+            done[it] = all(
+                i * dist.get_world_size() + rank + it * global_batch_size in existing for i in range(n)
+            )
+    done = done.to(device)
+    dist.all_reduce(done, op=dist.ReduceOp.MIN)
+    done = done.bool().tolist()
+    if rank == 0 and any(done):
+        print(f"Resuming sampling, skipping {sum(done)}/{iterations} iterations that are already saved.")
+
+    todo = [it for it in range(iterations) if not done[it]]
+    pbar = tqdm(todo) if rank == 0 else todo
+
+    # Samples are copied device-to-host on a separate stream into two persistent pinned buffers, so that the copy
+    # of a batch overlaps with sampling of the next one. Saving runs on a thread pool, reading the pinned buffers.
+    pinned_samples = [
+        torch.empty((n, config.resolution, config.resolution, 3), dtype=torch.uint8, pin_memory=True)
+        for _ in range(2)
+    ]
+    copy_stream = torch.cuda.Stream()
+    copy_events = [torch.cuda.Event() for _ in range(2)]
+    executor = ThreadPoolExecutor(max_workers=args.num_workers)
+    futures = [[], []]  # pending saves reading from each pinned buffer
+    chunks = [chunk for chunk in np.array_split(np.arange(n), args.num_workers) if len(chunk) > 0]
+    if args.sample_format == "npy":
+        # Raw uint8 samples of this rank, in sampling order
+        shard = np.lib.format.open_memmap(
+            f"{sample_folder_dir}/rank{rank}.npy", mode="w+", dtype=np.uint8,
+            shape=(samples_needed_this_gpu, config.resolution, config.resolution, 3),
+        )
+
+    def save_batch(buf, total):
+        # Save samples to disk in the background, either as individual .png files or to the .npy shard
+        copy_events[buf].synchronize()
+        samples = pinned_samples[buf].numpy()
+        if args.sample_format == "png":
+            indices = [i * dist.get_world_size() + rank + total for i in range(n)]
+            futures[buf] = [
+                executor.submit(
+                    save_samples, samples[chunk[0]:chunk[-1] + 1], indices[chunk[0]:chunk[-1] + 1], sample_folder_dir
+                )
+                for chunk in chunks
+            ]
+        else:
+            offset = total // dist.get_world_size()
+            futures[buf] = [
+                executor.submit(save_samples_to_shard, samples[chunk[0]:chunk[-1] + 1], offset + chunk[0], shard)
+                for chunk in chunks
+            ]
+
+    # The inputs of the next batch are drawn on a side stream, overlapping with sampling of the current one.
+    # Each iteration has its own generator seeded from (seed, iteration), which also drives the SDE noise, so
+    # the samples of an iteration do not depend on which other iterations run (e.g. when resuming).
+    rng_stream = torch.cuda.Stream()
+
+    def sample_inputs(it):
+        generator = torch.Generator(device=device).manual_seed(seed * iterations + it)
+        with torch.cuda.stream(rng_stream):
+            z = torch.randn(n, model.in_channels, latent_size, latent_size, device=device, generator=generator)
+            y = torch.randint(0, config.num_classes, (n,), device=device, generator=generator)
+        return z, y, generator
+
+    # The null class labels used for CFG are the same for every batch
+    y_null = torch.full((n,), config.num_classes, device=device, dtype=torch.long)
+
+    pending = None  # (buffer, total) of the previous batch, whose copy may still be in flight
+    with torch.inference_mode():
+        next_inputs = sample_inputs(todo[0]) if todo else None
+        for k, it in enumerate(pbar):
+            total = it * global_batch_size
+
+            # Sample inputs:
+            z, y, generator = next_inputs
+            torch.cuda.current_stream().wait_stream(rng_stream)
+            z.record_stream(torch.cuda.current_stream())
+            y.record_stream(torch.cuda.current_stream())
+            if k + 1 < len(todo):
+                next_inputs = sample_inputs(todo[k + 1])
+
+            assert not args.heun or args.mode == "ode", "Heun's method is only available for ODE sampling."
+
+            # Sample images:
+            sampling_kwargs = dict(
+                model=model, 
+                latents=z,
+                y=y,
+                num_steps=args.num_steps, 
+                heun=args.heun,
+                cfg_scale=args.cfg_scale,
+                guidance_low=args.guidance_low,
+                guidance_high=args.guidance_high,
+                path_type=args.path_type,
+                y_null=y_null,
+                generator=generator,
+            )
+            with torch.autocast("cuda", dtype=autocast_dtype, enabled=args.mixed_precision != "no"):
+                # Only allow the IO-aware flash / memory-efficient attention kernels in the denoiser
+                with sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]):
+                    if args.mode == "sde":
+                        samples = euler_maruyama_sampler(**sampling_kwargs).to(torch.float32)
+                    elif args.mode == "ode":
+                        samples = euler_sampler(**sampling_kwargs).to(torch.float32)
+                    else:
+                        raise NotImplementedError()
+
+                # Same as `denormalize_latents`, as a single fused multiply-add
+                samples = vae.decode(torch.addcmul(latents_bias, samples, latents_inv_scale)).sample
+
+            # Post-processing is done in fp32, outside of autocast
+            samples = postprocess(samples)
+
+            # Copy the samples to the pinned host buffer without blocking the default stream, once the
+            # saves of two batches ago are done reading it
+            buf = 0 if pending is None else 1 - pending[0]
+            for future in futures[buf]:
+                future.result()
+            copy_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(copy_stream):
+                pinned_samples[buf].copy_(samples, non_blocking=True)
+                copy_events[buf].record()
+            samples.record_stream(copy_stream)
+
+            # The previous batch is saved while the GPU works on this one
+            if pending is not None:
+                save_batch(*pending)
+            pending = (buf, total)
+
+    if pending is not None:
+        save_batch(*pending)
+    for future in futures[0] + futures[1]:
+        future.result()
+    executor.shutdown()
+    if args.sample_format == "npy":
+        shard.flush()
+        del shard
 
     # Make sure all processes have finished saving their samples before attempting to convert to .npz
     dist.barrier()
     if rank == 0:
-        create_npz_from_sample_folder(sample_folder_dir, args.num_fid_samples)
+        if args.sample_format == "png":
+            create_npz_from_sample_folder(sample_folder_dir, args.num_fid_samples)
+        else:
+            create_npz_from_sample_shards(sample_folder_dir, dist.get_world_size(), args.num_fid_samples)
         print("Done.")
     dist.barrier()
     dist.destroy_process_group()
@@ -230,9 +450,21 @@ if __name__ == "__main__":
     # precision params
     parser.add_argument("--tf32", action=argparse.BooleanOptionalAction, default=True,
                         help="By default, use TF32 matmuls. This massively accelerates sampling on Ampere GPUs.")
+    parser.add_argument("--mixed-precision", type=str, default="no", choices=["no", "fp16", "bf16"],
+                        help="Run the SiT denoiser and the VAE decoder under autocast with the given dtype.")
+    parser.add_argument("--compile", action=argparse.BooleanOptionalAction, default=False,
+                        help="Compile the SiT denoiser and the VAE decoder with CUDA graphs for faster sampling.")
+    parser.add_argument("--int8-quant", action=argparse.BooleanOptionalAction, default=False,
+                        help="Quantize the SiT linear layers to int8 with torchao (dynamic activation quantization).")
 
     # logging/saving params
     parser.add_argument("--sample-dir", type=str, default="samples")
+    parser.add_argument("--sample-format", type=str, default="png", choices=["png", "npy"],
+                        help="Save samples as individual .png files or as raw uint8 .npy shards (one per rank).")
+    parser.add_argument("--resume", action=argparse.BooleanOptionalAction, default=False,
+                        help="Skip the batches whose .png samples were already saved by a previous, interrupted run.")
+    parser.add_argument("--num-workers", type=int, default=8,
+                        help="Number of threads used to save samples to disk.")
 
     # ckpt params
     parser.add_argument("--exp-path", type=str, default=None, help="Path to the specific experiment directory.")
@@ -253,4 +485,7 @@ if __name__ == "__main__":
     parser.add_argument("--guidance-high", type=float, default=1.)
 
     args = parser.parse_args()
+    # Reduce fragmentation of the caching allocator with the large, fixed-shape VAE activations.
+    # Must be set before the first CUDA allocation.
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512")
     main(args)
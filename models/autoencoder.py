@@ -134,28 +134,54 @@ class AttnBlock(nn.Module):
         self.proj_out = torch.nn.Conv2d(
             in_channels, in_channels, kernel_size=1, stride=1, padding=0
         )
+        # opt-in, see `AutoencoderKL.enable_sdpa`
+        self.use_sdpa = False
+
+    @torch.no_grad()
+    def fuse_qkv(self):
+        """
+        Fuses the q, k, v projections into a single 1x1 convolution (inference only).
+        """
+        if hasattr(self, "qkv"):
+            return
+        convs = [self.q, self.k, self.v]
+        self.qkv = torch.nn.Conv2d(
+            self.in_channels, 3 * self.in_channels, kernel_size=1, stride=1, padding=0
+        ).to(device=self.q.weight.device, dtype=self.q.weight.dtype)
+        self.qkv.weight.copy_(torch.cat([conv.weight for conv in convs], dim=0))
+        self.qkv.bias.copy_(torch.cat([conv.bias for conv in convs], dim=0))
+        del self.q, self.k, self.v
 
     def forward(self, x):
         h_ = x
         h_ = self.norm(h_)
-        q = self.q(h_)
-        k = self.k(h_)
-        v = self.v(h_)
+        if hasattr(self, "qkv"):
+            q, k, v = self.qkv(h_).chunk(3, dim=1)
+        else:
+            q = self.q(h_)
+            k = self.k(h_)
+            v = self.v(h_)
 
-        # compute attention
         b, c, h, w = q.shape
-        q = q.reshape(b, c, h * w)
-        q = q.permute(0, 2, 1)  # b,hw,c
-        k = k.reshape(b, c, h * w)  # b,c,hw
-        w_ = torch.bmm(q, k)  # b,hw,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j]
-        w_ = w_ * (int(c) ** (-0.5))
-        w_ = torch.nn.functional.softmax(w_, dim=2)
-
-        # attend to values
-        v = v.reshape(b, c, h * w)
-        w_ = w_.permute(0, 2, 1)  # b,hw,hw (first hw of k, second of q)
-        h_ = torch.bmm(v, w_)  # b, c,hw (hw of q) h_[b,c,j] = sum_i v[b,c,i] w_[b,i,j]
-        h_ = h_.reshape(b, c, h, w)
+        if self.use_sdpa:
+            # a single SDPA head over the hw positions with c channels
+            q, k, v = (t.reshape(b, 1, c, h * w).transpose(2, 3) for t in (q, k, v))  # b,1,hw,c
+            h_ = torch.nn.functional.scaled_dot_product_attention(q, k, v)  # scale defaults to c**-0.5
+            h_ = h_.transpose(2, 3).reshape(b, c, h, w)
+        else:
+            # compute attention
+            q = q.reshape(b, c, h * w)
+            q = q.permute(0, 2, 1)  # b,hw,c
+            k = k.reshape(b, c, h * w)  # b,c,hw
+            w_ = torch.bmm(q, k)  # b,hw,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j]
+            w_ = w_ * (int(c) ** (-0.5))
+            w_ = torch.nn.functional.softmax(w_, dim=2)
+
+            # attend to values
+            v = v.reshape(b, c, h * w)
+            w_ = w_.permute(0, 2, 1)  # b,hw,hw (first hw of k, second of q)
+            h_ = torch.bmm(v, w_)  # b, c,hw (hw of q) h_[b,c,j] = sum_i v[b,c,i] w_[b,i,j]
+            h_ = h_.reshape(b, c, h, w)
 
         h_ = self.proj_out(h_)
 
@@ -473,6 +499,18 @@ class AutoencoderKL(nn.Module):
         dec = self.decoder(z)
         return dictdot(dict(sample=dec))
 
+    def fuse_qkv_projections(self):
+        # NOTE: changes the state dict keys of the attention blocks, call after loading the weights
+        for module in self.modules():
+            if isinstance(module, AttnBlock):
+                module.fuse_qkv()
+
+    def enable_sdpa(self):
+        # NOTE: opt-in for sampling, the attention blocks otherwise keep the original bmm / softmax attention
+        for module in self.modules():
+            if isinstance(module, AttnBlock):
+                module.use_sdpa = True
+
     def forward(self, x, return_recon=True):
         posterior = self.encode(x)
         z = posterior.sample()
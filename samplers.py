@@ -54,10 +54,15 @@ def euler_sampler(
         guidance_low=0.0,
         guidance_high=1.0,
         path_type="linear", # not used, just for compatability
+        y_null=None, # optionally precomputed null class labels for CFG
+        generator=None, # not used, just for compatability
     ):
     # setup conditioning
     if cfg_scale > 1.0:
-        y_null = torch.tensor([1000] * y.size(0), device=y.device)
+        if y_null is None:
+            y_null = torch.tensor([1000] * y.size(0), device=y.device)
+        # conditional and unconditional predictions are computed in a single batched forward pass
+        y_cfg = torch.cat([y, y_null], dim=0)
     _dtype = latents.dtype    
     t_steps = torch.linspace(1, 0, num_steps+1, dtype=torch.float64)
     x_next = latents.to(torch.float64)
@@ -68,12 +73,12 @@ def euler_sampler(
             x_cur = x_next
             if cfg_scale > 1.0 and t_cur <= guidance_high and t_cur >= guidance_low:
                 model_input = torch.cat([x_cur] * 2, dim=0)
-                y_cur = torch.cat([y, y_null], dim=0)
+                y_cur = y_cfg
             else:
                 model_input = x_cur
                 y_cur = y            
             kwargs = dict(y=y_cur)
-            time_input = torch.ones(model_input.size(0)).to(device=device, dtype=torch.float64) * t_cur
+            time_input = torch.full((model_input.size(0),), t_cur.item(), device=device, dtype=torch.float64)
             d_cur = model.inference(
                 model_input.to(dtype=_dtype), time_input.to(dtype=_dtype), **kwargs
             ).to(torch.float64)
@@ -84,14 +89,14 @@ def euler_sampler(
             if heun and (i < num_steps - 1):
                 if cfg_scale > 1.0 and t_cur <= guidance_high and t_cur >= guidance_low:
                     model_input = torch.cat([x_next] * 2)
-                    y_cur = torch.cat([y, y_null], dim=0)
+                    y_cur = y_cfg
                 else:
                     model_input = x_next
                     y_cur = y
                 kwargs = dict(y=y_cur)
-                time_input = torch.ones(model_input.size(0)).to(
-                    device=model_input.device, dtype=torch.float64
-                    ) * t_next
+                time_input = torch.full(
+                    (model_input.size(0),), t_next.item(), device=model_input.device, dtype=torch.float64
+                    )
                 d_prime = model.inference(
                     model_input.to(dtype=_dtype), time_input.to(dtype=_dtype), **kwargs
                     ).to(torch.float64)
@@ -113,10 +118,15 @@ def euler_maruyama_sampler(
         guidance_low=0.0,
         guidance_high=1.0,
         path_type="linear",
+        y_null=None, # optionally precomputed null class labels for CFG
+        generator=None, # optional random generator for the SDE noise
     ):
     # setup conditioning
     if cfg_scale > 1.0:
-        y_null = torch.tensor([1000] * y.size(0), device=y.device)
+        if y_null is None:
+            y_null = torch.tensor([1000] * y.size(0), device=y.device)
+        # conditional and unconditional predictions are computed in a single batched forward pass
+        y_cfg = torch.cat([y, y_null], dim=0)
             
     _dtype = latents.dtype
     
@@ -131,14 +141,14 @@ def euler_maruyama_sampler(
             x_cur = x_next
             if cfg_scale > 1.0 and t_cur <= guidance_high and t_cur >= guidance_low:
                 model_input = torch.cat([x_cur] * 2, dim=0)
-                y_cur = torch.cat([y, y_null], dim=0)
+                y_cur = y_cfg
             else:
                 model_input = x_cur
                 y_cur = y            
             kwargs = dict(y=y_cur)
-            time_input = torch.ones(model_input.size(0)).to(device=device, dtype=torch.float64) * t_cur
+            time_input = torch.full((model_input.size(0),), t_cur.item(), device=device, dtype=torch.float64)
             diffusion = compute_diffusion(t_cur)            
-            eps_i = torch.randn_like(x_cur).to(device)
+            eps_i = torch.randn(x_cur.size(), dtype=x_cur.dtype, device=device, generator=generator)
             deps = eps_i * torch.sqrt(torch.abs(dt))
 
             # compute drift
@@ -159,14 +169,14 @@ def euler_maruyama_sampler(
     x_cur = x_next
     if cfg_scale > 1.0 and t_cur <= guidance_high and t_cur >= guidance_low:
         model_input = torch.cat([x_cur] * 2, dim=0)
-        y_cur = torch.cat([y, y_null], dim=0)
+        y_cur = y_cfg
     else:
         model_input = x_cur
         y_cur = y            
     kwargs = dict(y=y_cur)
-    time_input = torch.ones(model_input.size(0)).to(
-        device=device, dtype=torch.float64
-        ) * t_cur
+    time_input = torch.full(
+        (model_input.size(0),), t_cur.item(), device=device, dtype=torch.float64
+        )
     
     # compute drift
     v_cur = model.inference(